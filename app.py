@@ -1,15 +1,25 @@
 import os
 import json
 import pickle
-from datetime import datetime, timedelta
-from functools import wraps
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+import hashlib
+import hmac
 import secrets
+import time
 import logging
+from collections import Counter, OrderedDict, defaultdict
+from uuid import uuid4
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, make_response
+from flask.json.provider import DefaultJSONProvider
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_wtf.csrf import CSRFProtect
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 
 # Google integration (optional)
@@ -23,14 +33,131 @@ except ImportError:
     GOOGLE_AVAILABLE = False
     print("⚠️  Google libraries not installed. Google integration disabled.")
 
+# Fast JSON codec (optional)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Argon2id password hashing (optional)
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import InvalidHashError, VerificationError
+    ARGON2_AVAILABLE = True
+except ImportError:
+    ARGON2_AVAILABLE = False
+
 # Configure logging
-os.makedirs('logs', exist_ok=True)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON (jsonify, session cookie) via orjson.
+
+    Dates and datetimes are passed through to Flask's default, so they still
+    serialize as HTTP dates rather than orjson's ISO 8601. Calls with options
+    orjson doesn't take fall back to Flask's provider.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if kwargs.get('separators') == (',', ':'):
+            del kwargs['separators']  # orjson output is already compact
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                  | (orjson.OPT_SORT_KEYS if self.sort_keys else 0))
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:  # e.g. the session serializer's object_hook, which orjson doesn't support
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
 app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# Behind a reverse proxy every request arrives from the proxy's address. Set
+# TRUSTED_PROXY_COUNT to the number of proxies in front so request.remote_addr
+# is the client's address from X-Forwarded-For.
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', '0'))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+
+# New password hashes use Argon2id when argon2-cffi is installed, else werkzeug's
+# scrypt. Existing werkzeug hashes (scrypt, pbkdf2) still verify and are upgraded
+# on the user's next successful login.
+PASSWORD_HASH_METHOD = 'scrypt'
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2) if ARGON2_AVAILABLE else None
+
+def hash_password(password):
+    if password_hasher:
+        return password_hasher.hash(password)
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+def check_password(pw_hash, password):
+    """Verify against an Argon2 or werkzeug hash."""
+    if pw_hash.startswith('$argon2'):
+        if not password_hasher:
+            logger.error("Argon2 password hash found but argon2-cffi is not installed")
+            return False
+        try:
+            return password_hasher.verify(pw_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(pw_hash, password)
+
+def password_needs_rehash(pw_hash):
+    if not password_hasher:
+        return False
+    return not pw_hash.startswith('$argon2') or password_hasher.check_needs_rehash(pw_hash)
+
+# Checked against for unknown usernames so login timing doesn't reveal which exist.
+# Replaced by load_data() with one as slow as the slowest stored hash format.
+DUMMY_PASSWORD_HASH = hash_password(secrets.token_hex(16))
+
+def slowest_dummy_hash(pw_hashes):
+    """A hash of a random password in whichever format among pw_hashes (and the
+    current default) takes longest to check. Until every user has logged in and
+    been rehashed, older pbkdf2/scrypt hashes can be slower than new ones."""
+    secret = secrets.token_hex(16)
+    candidates = {'default': hash_password(secret)}
+    for pw_hash in pw_hashes:
+        if not pw_hash or pw_hash.startswith('$argon2') or '$' not in pw_hash:
+            continue
+        method = pw_hash.split('$', 1)[0]
+        if method not in candidates:
+            try:
+                candidates[method] = generate_password_hash(secret, method=method)
+            except ValueError:
+                continue
+    if len(candidates) == 1:
+        return candidates['default']
+    timings = []
+    for candidate in candidates.values():
+        started = time.perf_counter()
+        check_password(candidate, secret + 'x')
+        timings.append((time.perf_counter() - started, candidate))
+    return max(timings)[1]
+
+# Successful checks are remembered briefly so a resubmitted login form doesn't
+# rerun the KDF. Keys are HMACs under a per-process key; failures are never cached.
+LOGIN_CACHE_TTL = 30
+_login_cache_key = secrets.token_bytes(32)
+_verified_logins = {}
+# Each (client address, username) pair gets LOGIN_MAX_FAILURES failed logins per
+# LOGIN_FAILURE_WINDOW seconds; past that, login is refused before any KDF runs.
+# Keying on the username too means guesses against one name, or against unknown
+# names, never lock out other accounts sharing the address (e.g. behind a proxy).
+LOGIN_MAX_FAILURES = 10
+LOGIN_FAILURE_WINDOW = 300
+# Entries are kept in window-start order, so expired ones sit at the front and
+# pruning stops at the first live one. Past LOGIN_FAILURES_TRACKED entries the
+# oldest is evicted, bounding memory when many usernames are sprayed.
+LOGIN_FAILURES_TRACKED = 10000
+_login_failures = OrderedDict()
+_login_failures_lock = threading.Lock()
 
 # CSRF Protection
 #csrf = CSRFProtect(app)
@@ -42,12 +169,86 @@ login_manager.login_view = "login"
 
 # Data storage
 DATA_DIR = 'data'
-os.makedirs(DATA_DIR, exist_ok=True)
-DATA_FILE = os.path.join(DATA_DIR, 'inanis_garage_data.pickle')
+for folder in ('logs', DATA_DIR, 'temp_uploads', 'static/css', 'templates'):
+    os.makedirs(folder, exist_ok=True)
+
+# Session signing key: SECRET_KEY when set, otherwise generated on first run and
+# kept next to the data so logins survive restarts
+SECRET_KEY_FILE = os.path.join(DATA_DIR, '.secret_key')
+
+def _read_secret_key():
+    try:
+        with open(SECRET_KEY_FILE, 'rb') as f:
+            key = f.read()
+    except FileNotFoundError:
+        return None
+    if not key:
+        logger.error(f"{SECRET_KEY_FILE} is empty; restore it or delete it to generate a new key")
+        raise RuntimeError(f"empty session key file {SECRET_KEY_FILE}")
+    return key
+
+def load_secret_key():
+    env_key = os.environ.get('SECRET_KEY')
+    if env_key:
+        return env_key
+    key = _read_secret_key()
+    if key:
+        return key
+    # Write the key to a temp file and fsync it before linking it into place, so
+    # the key file never exists empty or half-written. os.link fails if the file
+    # exists, so when two processes start together the loser reads the winner's key.
+    key = secrets.token_bytes(32)
+    tmp_path = f"{SECRET_KEY_FILE}.{uuid4().hex}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, SECRET_KEY_FILE)
+        except FileExistsError:
+            return _read_secret_key()
+    finally:
+        os.remove(tmp_path)
+    return key
+
+app.secret_key = load_secret_key()
+DB_FILE = os.path.join(DATA_DIR, 'garage.db')
+LEGACY_DATA_FILE = os.path.join(DATA_DIR, 'inanis_garage_data.pickle')
+
+# One table per collection; each row holds a single JSON-encoded record so a
+# mutation only rewrites the row it touched.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, json TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS vehicles (reg_no TEXT PRIMARY KEY, json TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS assignments (id INTEGER PRIMARY KEY, json TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS fuel_logs (car_id TEXT NOT NULL, idx INTEGER NOT NULL, json TEXT NOT NULL, PRIMARY KEY (car_id, idx));
+CREATE TABLE IF NOT EXISTS documents (car_id TEXT NOT NULL, idx INTEGER NOT NULL, json TEXT NOT NULL, PRIMARY KEY (car_id, idx));
+CREATE TABLE IF NOT EXISTS maintenance_records (car_id TEXT NOT NULL, idx INTEGER NOT NULL, json TEXT NOT NULL, PRIMARY KEY (car_id, idx));
+"""
+
+db = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+db.execute('PRAGMA journal_mode=WAL')
+db.execute('PRAGMA synchronous=NORMAL')
+# Let SQLite read pages straight from the page cache instead of copying them.
+db.execute('PRAGMA mmap_size=268435456')
+db.executescript(SCHEMA)
+db_lock = threading.Lock()
+# Bumped on every write so cached views know when to recompute
+state_version = 0
 
 # Google configuration
 SERVICE_ACCOUNT_FILE = os.environ.get('GOOGLE_CREDENTIALS', 'credentials.json')
 CALENDAR_ID = os.environ.get('CALENDAR_ID', 'primary')
+DRIVE_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_COPY_BUFFER = 1024 * 1024
+# Below this size a single multipart request beats a resumable session
+DRIVE_RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+# Retries for Google API calls on 429/5xx; googleapiclient backs off exponentially
+# with jitter between attempts. Calls run on single-worker executors, which
+# already keeps the request rate to one call in flight per service.
+GOOGLE_NUM_RETRIES = 3
 
 # Global data
 users = {}
@@ -56,12 +257,29 @@ assignments = []
 fuel_logs = {}
 documents = {}
 maintenance_records = {}
+# Secondary index over `assignments`, in insertion order per car
+assignments_by_car = defaultdict(list)
+# sha256 of uploaded content -> (drive_id, drive_link), to skip re-uploading duplicates
+drive_files_by_hash = {}
+# Serializes request-time writers to the structures above, so appends get distinct
+# row indexes. Readers never take it: `vehicles`, which index() iterates, is
+# replaced with a new dict on insert instead of growing under a render.
+state_lock = threading.Lock()
 
 # Google services
 driveservice = None
 calservice = None
 google_enabled = False
 
+# Drive uploads run off the request thread. The service object shares one
+# httplib2 connection, which is not thread-safe, so uploads are serialized.
+drive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='drive')
+# Calendar has its own service object and connection, so it gets its own worker.
+calendar_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='calendar')
+# New users' password hashes are computed here so add_user can respond at once;
+# the user is `pending` and can't log in until the hash is stored.
+password_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='passwords')
+
 def init_google_services():
     global driveservice, calservice, google_enabled
     if not GOOGLE_AVAILABLE or not os.path.exists(SERVICE_ACCOUNT_FILE):
@@ -77,63 +295,187 @@ def init_google_services():
         logger.error(f"Google initialization failed: {e}")
         return False
 
+def encode_record(record):
+    # orjson returns bytes; decode so rows are stored as TEXT, not BLOB (which
+    # SQLite's JSON functions would read as JSONB)
+    return orjson.dumps(record).decode() if ORJSON_AVAILABLE else json.dumps(record)
+
+def decode_record(raw):
+    return orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+
+def _load_keyed(table):
+    return {key: decode_record(rec) for key, rec in db.execute(f"SELECT * FROM {table}")}
+
+def _load_per_car(table):
+    grouped = {}
+    for car_id, _, rec in db.execute(f"SELECT * FROM {table} ORDER BY car_id, idx"):
+        grouped.setdefault(car_id, []).append(decode_record(rec))
+    return grouped
+
 def load_data():
-    global users, vehicles, assignments, fuel_logs, documents, maintenance_records
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'rb') as f:
-                data = pickle.load(f)
-                users = data.get('users', {})
-                vehicles = data.get('vehicles', {})
-                assignments = data.get('assignments', [])
-                fuel_logs = data.get('fuel_logs', {})
-                documents = data.get('documents', {})
-                maintenance_records = data.get('maintenance_records', {})
-        except Exception as e:
-            logger.error(f"Failed to load data: {e}")
+    global users, vehicles, assignments, fuel_logs, documents, maintenance_records, state_version
+    global DUMMY_PASSWORD_HASH
+    try:
+        with db_lock:
+            state_version += 1
+            users = _load_keyed('users')
+            vehicles = _load_keyed('vehicles')
+            assignments = [decode_record(rec) for (rec,) in db.execute("SELECT json FROM assignments ORDER BY id")]
+            fuel_logs = _load_per_car('fuel_logs')
+            documents = _load_per_car('documents')
+            maintenance_records = _load_per_car('maintenance_records')
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load data: {e}")
+
+    if not users and os.path.exists(LEGACY_DATA_FILE):
+        migrate_legacy_data()
+
+    assignments_by_car.clear()
+    for a in assignments:
+        assignments_by_car[a["car_id"]].append(a)
+
+    drive_files_by_hash.clear()
+    for car_docs in documents.values():
+        for doc in car_docs:
+            if doc.get('sha256') and doc.get('drive_id'):
+                drive_files_by_hash[doc['sha256']] = (doc['drive_id'], doc['drive_link'])
 
     # Initialize admin user if no users exist
     if not users:
         users = {
             "admin": {
-                "password": generate_password_hash("adminpass"), 
+                "password": hash_password("adminpass"), 
                 "role": "admin",
                 "created_date": datetime.now().isoformat(),
                 "garage_name": "Inanis Garage"
             }
         }
-        save_data()
+        save_rows(user_row("admin"))
+
+    DUMMY_PASSWORD_HASH = slowest_dummy_hash(u.get("password") for u in users.values())
 
-def save_data():
+def migrate_legacy_data():
+    """One-time import of the old whole-state pickle into the database."""
+    global users, vehicles, assignments, fuel_logs, documents, maintenance_records
     try:
-        data = {
-            'users': users,
-            'vehicles': vehicles, 
-            'assignments': assignments,
-            'fuel_logs': fuel_logs,
-            'documents': documents,
-            'maintenance_records': maintenance_records,
-            'garage_info': {
-                'name': 'Inanis Garage',
-                'version': '2.0.0',
-                'last_updated': datetime.now().isoformat()
-            }
-        }
-        with open(DATA_FILE, 'wb') as f:
-            pickle.dump(data, f)
+        with open(LEGACY_DATA_FILE, 'rb') as f:
+            data = pickle.load(f)
     except Exception as e:
+        logger.error(f"Failed to read legacy data file: {e}")
+        return
+    users = data.get('users', {})
+    vehicles = data.get('vehicles', {})
+    assignments = data.get('assignments', [])
+    fuel_logs = data.get('fuel_logs', {})
+    documents = data.get('documents', {})
+    maintenance_records = data.get('maintenance_records', {})
+
+    rows = [("users", (k, encode_record(v))) for k, v in users.items()]
+    rows += [("vehicles", (k, encode_record(v))) for k, v in vehicles.items()]
+    rows += [("assignments", (i, encode_record(a))) for i, a in enumerate(assignments)]
+    for table, grouped in (("fuel_logs", fuel_logs), ("documents", documents),
+                           ("maintenance_records", maintenance_records)):
+        rows += [(table, (car_id, i, encode_record(rec)))
+                 for car_id, recs in grouped.items() for i, rec in enumerate(recs)]
+    if save_rows(*rows):
+        logger.info(f"✅ Migrated {LEGACY_DATA_FILE} into {DB_FILE}")
+
+def save_rows(*rows):
+    """Upsert (table, params) rows in a single transaction so related
+    changes land on disk together or not at all."""
+    global state_version
+    try:
+        with db_lock:
+            state_version += 1
+            db.execute("BEGIN")
+            try:
+                for table, params in rows:
+                    placeholders = ", ".join("?" * len(params))
+                    db.execute(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", params)
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        return True
+    except sqlite3.Error as e:
         logger.error(f"Failed to save data: {e}")
+        return False
+
+def user_row(username):
+    return "users", (username, encode_record(users[username]))
+
+def vehicle_row(vid):
+    return "vehicles", (vid, encode_record(vehicles[vid]))
+
+def assignment_row(idx):
+    return "assignments", (idx, encode_record(assignments[idx]))
+
+def fuel_log_row(car_id, idx):
+    return "fuel_logs", (car_id, idx, encode_record(fuel_logs[car_id][idx]))
+
+def document_row(car_id, idx):
+    return "documents", (car_id, idx, encode_record(documents[car_id][idx]))
 
 class User(UserMixin):
+    __slots__ = ('id', 'role')
+
     def __init__(self, username, role):
         self.id = username
         self.role = role
 
+@lru_cache(maxsize=1024)
+def cached_user(username, role):
+    """One shared User per (username, role); a role change simply gets a new entry."""
+    return User(username, role)
+
 @login_manager.user_loader
 def load_user(username):
     user = users.get(username)
     if user:
-        return User(username, user["role"])
+        return cached_user(username, user["role"])
+
+def verify_password(pw_hash, password):
+    """check_password, skipping the KDF for a pair verified within LOGIN_CACHE_TTL."""
+    token = hmac.new(_login_cache_key, f"{pw_hash}\0{password}".encode(), hashlib.sha256).digest()
+    now = time.monotonic()
+    verified_at = _verified_logins.get(token)
+    if verified_at is not None and now - verified_at < LOGIN_CACHE_TTL:
+        return True
+    if not check_password(pw_hash, password):
+        return False
+    for stale, ts in list(_verified_logins.items()):
+        if now - ts >= LOGIN_CACHE_TTL:
+            _verified_logins.pop(stale, None)
+    _verified_logins[token] = now
+    return True
+
+def login_throttled(key):
+    """True if key, an (addr, username) pair, has used up its failed logins for the current window."""
+    with _login_failures_lock:
+        entry = _login_failures.get(key)
+    return (entry is not None and time.monotonic() - entry[0] < LOGIN_FAILURE_WINDOW
+            and entry[1] >= LOGIN_MAX_FAILURES)
+
+def record_login_failure(key):
+    now = time.monotonic()
+    with _login_failures_lock:
+        while _login_failures:
+            started, _ = next(iter(_login_failures.values()))
+            if now - started < LOGIN_FAILURE_WINDOW:
+                break
+            _login_failures.popitem(last=False)
+        entry = _login_failures.get(key)
+        if entry is not None:
+            # Reassigning an existing key keeps its place in the order
+            _login_failures[key] = (entry[0], entry[1] + 1)
+            return
+        _login_failures[key] = (now, 1)
+        if len(_login_failures) > LOGIN_FAILURES_TRACKED:
+            _login_failures.popitem(last=False)
+
+def clear_login_failures(key):
+    with _login_failures_lock:
+        _login_failures.pop(key, None)
 
 def admin_required(f):
     @wraps(f)
@@ -144,18 +486,56 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def upload_file_to_drive(file_path):
+def upload_file_to_drive(file_path, name=None):
     if not google_enabled or not driveservice:
         return None, None
     try:
-        file_metadata = {"name": f"InanisGarage_{os.path.basename(file_path)}"}
-        media = MediaFileUpload(file_path, resumable=True)
-        file = driveservice.files().create(body=file_metadata, media_body=media, fields='id, webViewLink').execute()
+        file_metadata = {"name": f"InanisGarage_{name or os.path.basename(file_path)}"}
+        if os.path.getsize(file_path) < DRIVE_RESUMABLE_THRESHOLD:
+            media = MediaFileUpload(file_path, resumable=False)
+            upload = driveservice.files().create(body=file_metadata, media_body=media, fields='id, webViewLink')
+            file = upload.execute(num_retries=GOOGLE_NUM_RETRIES)
+        else:
+            media = MediaFileUpload(file_path, resumable=True, chunksize=DRIVE_CHUNK_SIZE)
+            upload = driveservice.files().create(body=file_metadata, media_body=media, fields='id, webViewLink')
+            # Send chunk by chunk; a chunk that fails is retried on its own
+            # instead of restarting the whole file
+            file = None
+            while file is None:
+                status, file = upload.next_chunk(num_retries=GOOGLE_NUM_RETRIES)
+                if status:
+                    logger.debug(f"Drive upload {file_metadata['name']}: {int(status.progress() * 100)}%")
         return file.get('id'), file.get('webViewLink')
     except Exception as e:
         logger.error(f"Drive upload failed: {e}")
         return None, None
 
+def save_upload_hashed(file, path):
+    """Copy an uploaded file to path in UPLOAD_COPY_BUFFER chunks, hashing it on
+    the way through; returns the sha256 hex digest."""
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_COPY_BUFFER), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+def sync_document_to_drive(car_id, idx, local_path):
+    """Upload a saved document to Drive and record its link (runs on drive_executor)."""
+    try:
+        doc = documents[car_id][idx]
+        file_id, web_link = upload_file_to_drive(local_path, doc['filename'])
+        if file_id:
+            doc['drive_id'] = file_id
+            doc['drive_link'] = web_link
+            save_rows(document_row(car_id, idx))
+            if doc.get('sha256'):
+                drive_files_by_hash[doc['sha256']] = (file_id, web_link)
+            logger.info(f"✅ Document for {car_id} synced to Google Drive")
+    finally:
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
 def create_calendar_event(summary, description, start_date, end_date):
     if not google_enabled or not calservice:
         return None
@@ -166,40 +546,74 @@ def create_calendar_event(summary, description, start_date, end_date):
             'start': {'date': start_date},
             'end': {'date': end_date},
         }
-        event = calservice.events().insert(calendarId=CALENDAR_ID, body=event).execute()
+        event = calservice.events().insert(calendarId=CALENDAR_ID, body=event).execute(num_retries=GOOGLE_NUM_RETRIES)
         return event.get('htmlLink')
     except Exception as e:
         logger.error(f"Calendar event failed: {e}")
         return None
 
+_today_cache = [None, 0.0]
+# Last rendered dashboard per user as (etag, rendered_at, html). The ETag already
+# covers user, role, data version and date, so a matching entry is current; the
+# TTL just bounds how long a page is reused without re-rendering.
+INDEX_CACHE_TTL = 30
+_rendered_index = {}
+# state_version restarts at 0 with the process, so ETags also carry a per-process
+# nonce; a tag issued before a restart never matches data loaded after it.
+_etag_nonce = secrets.token_hex(8)
+
+def today_iso():
+    """Today's date as YYYY-MM-DD, re-read from the clock at most every 30 seconds."""
+    now = time.monotonic()
+    if _today_cache[0] is None or now - _today_cache[1] > 30:
+        _today_cache[:] = [date.today().isoformat(), now]
+    return _today_cache[0]
+
+@lru_cache(maxsize=8)
+def dashboard_summary(today, version):
+    """Vehicle status and counters for the dashboard, cached per (day, state_version)."""
+    status = {
+        vid: next((a["driver"] for a in assignments_by_car.get(vid, ())
+                   if a["start_date"] <= today <= a["end_date"]), "Available")
+        for vid in vehicles
+    }
+    counts = Counter(who == "Available" for who in status.values())
+    return status, counts[True], counts[False]
+
 # Routes
 @app.route('/')
 @login_required
 def index():
-    status = {}
-    available_count = 0
-    assigned_count = 0
-    
-    today = datetime.today().strftime("%Y-%m-%d")
-    for vid, v in vehicles.items():
-        who = "Available"
-        for a in assignments:
-            if a["car_id"] == vid and a["start_date"] <= today <= a["end_date"]:
-                who = a["driver"]
-                break
-        status[vid] = who
-        
-        if who == "Available":
-            available_count += 1
-        else:
-            assigned_count += 1
-    
-    return render_template('index.html', 
-                         vehicles=vehicles, 
-                         status=status, 
-                         role=current_user.role,
-                         available_count=available_count,
-                         assigned_count=assigned_count)
+    today, version = today_iso(), state_version
+    # The page only varies with the viewer, the data version and the date, so
+    # browsers can revalidate with If-None-Match. Pending flashes must render.
+    etag = hashlib.sha1(f"{_etag_nonce}:{current_user.id}:{current_user.role}:{version}:{today}".encode()).hexdigest()
+    has_flashes = '_flashes' in session
+    if not has_flashes and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    now = time.monotonic()
+    cached = _rendered_index.get(current_user.id)
+    if not has_flashes and cached and cached[0] == etag and now - cached[1] < INDEX_CACHE_TTL:
+        html = cached[2]
+    else:
+        status, available_count, assigned_count = dashboard_summary(today, version)
+        html = render_template('index.html', 
+                             vehicles=vehicles, 
+                             status=status, 
+                             role=current_user.role,
+                             available_count=available_count,
+                             assigned_count=assigned_count)
+        # A page rendered with flashes consumed them; don't replay it later
+        if not has_flashes:
+            _rendered_index[current_user.id] = (etag, now, html)
+
+    response = make_response(html)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -207,12 +621,23 @@ def login():
     if request.method == 'POST':
         uname = request.form['username']
         pwd = request.form['password']
+        throttle_key = (request.remote_addr, uname)
+        if login_throttled(throttle_key):
+            flash("Too many failed logins. Please wait a few minutes and try again.", "error")
+            return render_template('login.html'), 429
         user = users.get(uname)
-        if user and check_password_hash(user["password"], pwd):
-            login_user(User(uname, user['role']))
+        ready = user is not None and not user.get("pending")
+        password_ok = verify_password(user["password"] if ready else DUMMY_PASSWORD_HASH, pwd)
+        if ready and password_ok:
+            clear_login_failures(throttle_key)
+            if password_needs_rehash(user["password"]):
+                user["password"] = hash_password(pwd)
+                save_rows(user_row(uname))
+            login_user(cached_user(uname, user['role']))
             flash(f"Welcome to Inanis Garage, {uname}!", "success")
             return redirect(url_for('index'))
         else:
+            record_login_failure(throttle_key)
             flash("Invalid username or password for Inanis Garage access.", "error")
     return render_template('login.html')
 
@@ -227,13 +652,10 @@ def logout():
 @login_required
 @admin_required
 def add_vehicle():
+    global vehicles
     if request.method == 'POST':
         vid = request.form['reg_no'].strip().upper()
-        if vid in vehicles:
-            flash("Vehicle already exists in Inanis Garage.", "error")
-            return render_template('add_vehicle.html')
-
-        vehicles[vid] = {
+        record = {
             "make": request.form['make'].strip(),
             "model": request.form['model'].strip(),
             "year": int(request.form['year']),
@@ -244,7 +666,12 @@ def add_vehicle():
             "created_date": datetime.now().isoformat(),
             "garage": "Inanis Garage"
         }
-        save_data()
+        with state_lock:
+            if vid in vehicles:
+                flash("Vehicle already exists in Inanis Garage.", "error")
+                return render_template('add_vehicle.html')
+            vehicles = {**vehicles, vid: record}
+            save_rows(vehicle_row(vid))
         flash(f"Vehicle {vid} added to Inanis Garage!", "success")
         return redirect(url_for('index'))
     return render_template('add_vehicle.html')
@@ -259,7 +686,7 @@ def vehicle(car_id):
 
     docs = documents.get(car_id, [])
     flogs = fuel_logs.get(car_id, [])
-    assigned = [a for a in assignments if a["car_id"] == car_id]
+    assigned = assignments_by_car.get(car_id, [])
     maintenance = maintenance_records.get(car_id, [])
 
     return render_template('vehicle.html', v=v, docs=docs, flogs=flogs, 
@@ -277,17 +704,19 @@ def assign_driver(car_id):
         "car_id": car_id, "driver": driver, "start_date": start_date, "end_date": end_date,
         "assigned_by": current_user.id, "garage": "Inanis Garage"
     }
-    assignments.append(assignment)
-
-    event_link = create_calendar_event(
-        summary=f"Vehicle {car_id} assigned to {driver}",
-        description=f"Vehicle assignment from Inanis Garage",
-        start_date=start_date, end_date=end_date
-    )
-
-    save_data()
-    if event_link:
-        flash("Driver assigned! Calendar event created.", "success")
+    with state_lock:
+        assignments.append(assignment)
+        assignments_by_car[car_id].append(assignment)
+        save_rows(assignment_row(len(assignments) - 1))
+
+    if google_enabled:
+        calendar_executor.submit(
+            create_calendar_event,
+            summary=f"Vehicle {car_id} assigned to {driver}",
+            description=f"Vehicle assignment from Inanis Garage",
+            start_date=start_date, end_date=end_date
+        )
+        flash("Driver assigned! Calendar event is being created.", "success")
     else:
         flash("Driver assigned successfully in Inanis Garage!", "success")
     return redirect(url_for('vehicle', car_id=car_id))
@@ -307,9 +736,11 @@ def add_fuel(car_id):
             "liters": liters, "cost": cost,
             "driver": current_user.id
         }
-        fuel_logs.setdefault(car_id, []).append(log)
-        vehicles[car_id]["odo"] = curr
-        save_data()
+        with state_lock:
+            car_logs = fuel_logs.setdefault(car_id, [])
+            car_logs.append(log)
+            vehicles[car_id]["odo"] = curr
+            save_rows(fuel_log_row(car_id, len(car_logs) - 1), vehicle_row(car_id))
         flash(f"Fuel log added for {car_id}", "success")
     except ValueError:
         flash("Please enter valid numbers.", "error")
@@ -326,25 +757,26 @@ def upload_document(car_id):
         notes = request.form.get('notes', '')
         
         if file and file.filename:
+            now = datetime.now()
             filename = secure_filename(file.filename)
-            # Add timestamp to avoid conflicts
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            # Descriptive name for the record and Drive; the temp file gets a random
+            # name since it outlives the request while the Drive upload runs
+            timestamp = now.strftime("%Y%m%d_%H%M%S")
             filename = f"{car_id}_{doc_type.replace(' ', '_')}_{timestamp}_{filename}"
             
-            os.makedirs('temp_uploads', exist_ok=True)
-            local_path = os.path.join('temp_uploads', filename)
+            local_path = os.path.join('temp_uploads', uuid4().hex + os.path.splitext(filename)[1].lower()[:8])
             
             try:
-                file.save(local_path)
-                file_id, web_link = upload_file_to_drive(local_path)
+                content_hash = save_upload_hashed(file, local_path)
+                drive_id, drive_link = drive_files_by_hash.get(content_hash, (None, None))
                 
                 # Calculate days until expiry
                 days_until_expiry = None
                 expiry_status = "valid"
                 if expiry:
                     try:
-                        expiry_date = datetime.strptime(expiry, '%Y-%m-%d').date()
-                        days_until_expiry = (expiry_date - datetime.now().date()).days
+                        expiry_date = date.fromisoformat(expiry)
+                        days_until_expiry = (expiry_date - now.date()).days
                         if days_until_expiry < 0:
                             expiry_status = "expired"
                         elif days_until_expiry <= 30:
@@ -359,21 +791,29 @@ def upload_document(car_id):
                     'days_until_expiry': days_until_expiry,
                     'filename': filename,
                     'original_filename': file.filename,
-                    'drive_link': web_link,
-                    'drive_id': file_id,
+                    'drive_link': drive_link,
+                    'drive_id': drive_id,
+                    'sha256': content_hash,
                     'notes': notes,
-                    'uploaded_date': datetime.now().isoformat(),
+                    'uploaded_date': now.isoformat(),
                     'uploaded_by': current_user.id,
                     'garage': 'Inanis Garage'
                 }
                 
-                documents.setdefault(car_id, []).append(doc_record)
-                save_data()
+                with state_lock:
+                    car_docs = documents.setdefault(car_id, [])
+                    car_docs.append(doc_record)
+                    doc_idx = len(car_docs) - 1
+                    save_rows(document_row(car_id, doc_idx))
                 
                 logger.info(f"✅ Document uploaded for {car_id} by {current_user.id}")
                 
-                if web_link:
-                    flash(f"Document '{doc_type}' uploaded to Google Drive successfully!", "success")
+                if drive_link:
+                    flash(f"Document '{doc_type}' is already in Google Drive; linked the existing copy.", "success")
+                elif google_enabled:
+                    drive_executor.submit(sync_document_to_drive, car_id, doc_idx, local_path)
+                    local_path = None  # the Drive worker removes it after uploading
+                    flash(f"Document '{doc_type}' saved and is uploading to Google Drive.", "success")
                 else:
                     flash(f"Document '{doc_type}' saved locally (Google Drive unavailable).", "warning")
                     
@@ -381,7 +821,7 @@ def upload_document(car_id):
                 logger.error(f"Document upload failed: {e}")
                 flash("Document upload failed. Please try again.", "error")
             finally:
-                if os.path.exists(local_path):
+                if local_path and os.path.exists(local_path):
                     os.remove(local_path)
         else:
             flash("Please select a file to upload.", "error")
@@ -391,6 +831,27 @@ def upload_document(car_id):
     return render_template('add_document.html', car_id=car_id)
 
 
+def finalize_user(username, password):
+    """Hash a pending user's password and save the user (runs on password_executor).
+
+    On any failure the pending placeholder is removed, so the name is free to be
+    added again instead of staying blocked with no password.
+    """
+    try:
+        pw_hash = hash_password(password)
+        with state_lock:
+            record = dict(users[username], password=pw_hash)
+            record.pop("pending", None)
+            if not save_rows(("users", (username, encode_record(record)))):
+                raise RuntimeError("could not save the user")
+            users[username] = record
+        logger.info(f"✅ User {username} created")
+    except Exception as e:
+        logger.error(f"Failed to finish creating user {username}: {e}")
+        with state_lock:
+            if users.get(username, {}).get("pending"):
+                del users[username]
+
 @app.route('/add_user', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -400,17 +861,18 @@ def add_user():
         pwd = request.form['password']
         role = request.form['role']
 
-        if uname in users:
-            flash("Username already exists.", "error")
-            return render_template('add_user.html')
-
-        users[uname] = {
-            "password": generate_password_hash(pwd),
-            "role": role,
-            "created_date": datetime.now().isoformat()
-        }
-        save_data()
-        flash(f"User {uname} added to Inanis Garage!", "success")
+        with state_lock:
+            if uname in users:
+                flash("Username already exists.", "error")
+                return render_template('add_user.html')
+            users[uname] = {
+                "password": None,
+                "role": role,
+                "created_date": datetime.now().isoformat(),
+                "pending": True
+            }
+        password_executor.submit(finalize_user, uname, pwd)
+        flash(f"User {uname} is being added to Inanis Garage and can log in shortly.", "success")
         return redirect(url_for('index'))
 
     return render_template('add_user.html')
@@ -426,26 +888,40 @@ def update_driver_license(username):
     if not user or user['role'] != 'driver':
         flash("Driver not found.", "error")
         return redirect(url_for('index'))
+    if user.get("pending"):
+        flash("This driver is still being set up. Try again in a moment.", "error")
+        return redirect(url_for('index'))
 
     if request.method == 'POST':
         license_num = request.form['license_number']
         license_doc_link = request.form['license_doc_link']
 
-        user['license_number'] = license_num
-        user['license_doc_link'] = license_doc_link
-        save_data()
+        # Under state_lock so this can't interleave with finalize_user and save
+        # a stale copy of the row
+        with state_lock:
+            user = users.get(username)
+            if not user or user.get("pending"):
+                flash("Driver not found.", "error")
+                return redirect(url_for('index'))
+            user['license_number'] = license_num
+            user['license_doc_link'] = license_doc_link
+            save_rows(user_row(username))
         flash("Driver license info updated!", "success")
         return redirect(url_for('index'))
 
     return render_template('update_driver_license.html', user=user, username=username)
 
-if __name__ == "__main__":
-    os.makedirs('temp_uploads', exist_ok=True)
-    os.makedirs('static/css', exist_ok=True)
-    os.makedirs('templates', exist_ok=True)
+def startup():
+    """Connect to Google and load the database; run once per serving process."""
+    # Google discovery is network-bound and load_data is disk-bound; overlap them
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        google_ready = pool.submit(init_google_services)
+        data_ready = pool.submit(load_data)
+        google_ready.result()
+        data_ready.result()
 
-    init_google_services()
-    load_data()
+if __name__ == "__main__":
+    startup()
 
     print("🔧 Inanis Garage Management System Starting...")
     print(f"📊 Google Integration: {'✅ Enabled' if google_enabled else '❌ Disabled'}")
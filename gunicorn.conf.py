@@ -0,0 +1,20 @@
+# Gunicorn settings for Inanis Garage: gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Vehicles, users and the login/dashboard caches live in process memory and
+# are only refreshed from SQLite at startup, so a second worker process would
+# serve stale data. Scale with threads in the single worker instead; Google
+# calls and KDF checks release the GIL while they wait.
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+timeout = 120
+
+accesslog = '-'
+
+
+def post_worker_init(worker):
+    from app import startup
+    startup()
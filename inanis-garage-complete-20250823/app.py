@@ -1,15 +1,28 @@
 import os
 import json
 import pickle
+import mmap
+import atexit
+import threading
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from functools import wraps
+from functools import lru_cache, wraps
 import secrets
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_wtf.csrf import CSRFProtect
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# Fast JSON codec (optional)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # ─── Setup logging and app ──────────────────────────────────────────────
 os.makedirs('logs', exist_ok=True)
 logging.basicConfig(level=logging.INFO)
@@ -26,11 +39,24 @@ login_manager.login_view = "login"
 DATA_DIR = 'data'
 os.makedirs(DATA_DIR, exist_ok=True)
 DATA_FILE = os.path.join(DATA_DIR, 'inanis_garage_data.pickle')
+SAVE_DEBOUNCE_SECONDS = 1.0
+# Dev-only: skip the fsync before each save's rename
+DATA_UNSAFE = os.environ.get('DATA_UNSAFE') == '1'
 
 for folder in ['static/css', 'static/car_thumbnails', 'static/documents', 'temp_uploads', 'templates']:
     os.makedirs(folder, exist_ok=True)
 
+# werkzeug hash of the documented default password "adminpass", precomputed so a
+# cold start doesn't spend ~100ms of pbkdf2 on a password that is public anyway
+ADMIN_SEED_PASSWORD_HASH = ('pbkdf2:sha256:260000$pa20Gp4cJ7GJ7zMk$'
+                            '2416386c6e34194c23fee630f974dad9228022c994823ea6c6c65e001589e2e5')
+
 BACKUP_ID_FILE = os.path.join(DATA_DIR, 'backup_file_id.txt')
+DRIVE_CHUNK_SIZE = 8 * 1024 * 1024
+# Below this size a single multipart request beats a resumable session
+DRIVE_RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+# Set when GOOGLE_DRIVE_FOLDER_ID is already shared, to save a permissions call per upload
+DRIVE_SKIP_PERMS = os.environ.get('GOOGLE_DRIVE_SKIP_PERMS') == '1'
 
 # ─── In-memory data storage ────────────────────────────────────────────
 users = {}
@@ -44,6 +70,9 @@ maintenance_records = {}
 driveservice = None
 calservice = None
 google_enabled = False
+# googleapiclient.http classes, resolved once by init_google_services()
+MediaInMemoryUpload = None
+MediaIoBaseDownload = None
 
 def get_google_credentials():
     try:
@@ -51,7 +80,7 @@ def get_google_credentials():
         if not creds_json:
             logger.warning("GOOGLE_CREDENTIALS_JSON environment variable not set")
             return None
-        creds = json.loads(creds_json)
+        creds = orjson.loads(creds_json) if ORJSON_AVAILABLE else json.loads(creds_json)
         logger.info("Google credentials successfully loaded from environment variable")
         return creds
     except Exception as e:
@@ -59,7 +88,7 @@ def get_google_credentials():
         return None
 
 def init_google_services():
-    global driveservice, calservice, google_enabled
+    global driveservice, calservice, google_enabled, MediaInMemoryUpload, MediaIoBaseDownload
     creds = get_google_credentials()
     if not creds:
         logger.info("Google Drive disabled: no valid credentials")
@@ -67,6 +96,7 @@ def init_google_services():
     try:
         from google.oauth2 import service_account
         from googleapiclient.discovery import build
+        from googleapiclient.http import MediaInMemoryUpload, MediaIoBaseDownload
         credentials = service_account.Credentials.from_service_account_info(
             creds, scopes=['https://www.googleapis.com/auth/drive.file', 'https://www.googleapis.com/auth/calendar']
         )
@@ -78,30 +108,35 @@ def init_google_services():
         logger.error(f"Google init failed: {e}")
         google_enabled = False
 
-def upload_file_to_drive(file_path):
+def upload_bytes_to_drive(name, payload):
     if not google_enabled or not driveservice:
-        return None, None
+        return None
     try:
-        from googleapiclient.http import MediaFileUpload
         metadata = {
-            'name': os.path.basename(file_path),
+            'name': name,
             'parents': [os.environ.get('GOOGLE_DRIVE_FOLDER_ID', 'root')]
         }
-        media = MediaFileUpload(file_path, resumable=True)
-        f = driveservice.files().create(body=metadata, media_body=media, fields='id,webViewLink').execute()
-        driveservice.permissions().create(fileId=f['id'], body={'type': 'anyone', 'role': 'reader'}).execute()
-        return f['id'], f['webViewLink']
+        if len(payload) < DRIVE_RESUMABLE_THRESHOLD:
+            media = MediaInMemoryUpload(payload, mimetype='application/octet-stream', resumable=False)
+        else:
+            media = MediaInMemoryUpload(payload, mimetype='application/octet-stream',
+                                        resumable=True, chunksize=DRIVE_CHUNK_SIZE)
+        f = driveservice.files().create(body=metadata, media_body=media, fields='id',
+                                        supportsAllDrives=True).execute()
+        if not DRIVE_SKIP_PERMS:
+            driveservice.permissions().create(fileId=f['id'], body={'type': 'anyone', 'role': 'reader'},
+                                              supportsAllDrives=True).execute()
+        return f['id']
     except Exception as e:
+        # Runs on the backup worker, outside any request, so log rather than flash
         logger.error(f"Google Drive upload failed: {e}")
-        flash(f"⚠️ Google Drive upload error: {e}", "warning")
-        return None, None
+        return None
 
 def download_file_from_drive(file_id, dest_path):
     try:
-        from googleapiclient import http as _http
         request = driveservice.files().get_media(fileId=file_id)
         with open(dest_path, 'wb') as f:
-            downloader = _http.MediaIoBaseDownload(f, request)
+            downloader = MediaIoBaseDownload(f, request)
             done = False
             while not done:
                 status, done = downloader.next_chunk()
@@ -144,16 +179,19 @@ def load_backup_file_id():
 def load_data():
     global users, vehicles, assignments, fuel_logs, documents, maintenance_records
 
-    drive_id = os.environ.get('GOOGLE_DATA_BACKUP_FILE_ID') or load_backup_file_id()
-
-    if not os.path.exists(DATA_FILE) and google_enabled and driveservice:
+    have_local = os.path.isfile(DATA_FILE)
+    # Restore from Drive only on a truly cold start with no local pickle
+    if not have_local and google_enabled and driveservice:
+        drive_id = os.environ.get('GOOGLE_DATA_BACKUP_FILE_ID') or load_backup_file_id()
         if drive_id:
             download_file_from_drive(drive_id, DATA_FILE)
+            have_local = os.path.isfile(DATA_FILE)
 
-    if os.path.exists(DATA_FILE):
+    if have_local:
         try:
-            with open(DATA_FILE, 'rb') as f:
-                data = pickle.load(f)
+            # Unpickle straight from the page cache instead of copying the file in
+            with open(DATA_FILE, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = pickle.loads(mm)
             users = data.get('users', {})
             vehicles = data.get('vehicles', {})
             assignments = data.get('assignments', [])
@@ -165,50 +203,136 @@ def load_data():
 
     if not users:
         users["admin"] = {
-            "password": generate_password_hash("adminpass"),
+            "password": ADMIN_SEED_PASSWORD_HASH,
             "role": "admin",
             "created_date": datetime.now().isoformat()
         }
         save_data()
 
 def save_data():
-    data = {
-        'users': users,
-        'vehicles': vehicles,
-        'assignments': assignments,
-        'fuel_logs': fuel_logs,
-        'documents': documents,
-        'maintenance_records': maintenance_records,
-    }
+    with _save_lock:
+        # Shallow copies so routes adding entries mid-dump can't break the pickler
+        data = {
+            'users': dict(users),
+            'vehicles': dict(vehicles),
+            'assignments': list(assignments),
+            'fuel_logs': dict(fuel_logs),
+            'documents': dict(documents),
+            'maintenance_records': dict(maintenance_records),
+        }
+        tmp_path = None
+        try:
+            # Pickle to bytes once: one write() to disk, and the Drive backup
+            # uploads the same buffer instead of reading the file back
+            payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            # Write a sibling temp file and rename it over DATA_FILE, so a crash
+            # mid-save leaves the previous pickle intact
+            with tempfile.NamedTemporaryFile(dir=DATA_DIR, suffix='.tmp', delete=False) as f:
+                tmp_path = f.name
+                f.write(payload)
+                f.flush()
+                if not DATA_UNSAFE:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, DATA_FILE)
+        except Exception as e:
+            logger.error(f"Failed to save data: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        # Still under the lock, so concurrent saves hand over payloads in order
+        schedule_backup(payload)
+
+# ─── Background Drive backup ───────────────────────────────────────────
+# One worker keeps backups ordered; a backup that is queued but not yet
+# started already picks up the newest payload, so further saves don't queue more.
+_drive_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='drive-backup')
+_backup_pending = threading.Event()
+_backup_payload = None
+
+def schedule_backup(payload):
+    global _backup_payload
+    if not google_enabled or not driveservice:
+        return
+    _backup_payload = payload
+    if not _backup_pending.is_set():
+        _backup_pending.set()
+        try:
+            _drive_pool.submit(_backup_to_drive)
+        except RuntimeError:
+            pass  # pool already shut down at exit; flush_save uploads it inline
+
+def _backup_to_drive():
     try:
-        with open(DATA_FILE, 'wb') as f:
-            pickle.dump(data, f)
+        # Clear before reading, so a save landing in between queues a new backup
+        _backup_pending.clear()
+        payload = _backup_payload
+        backup_id = upload_bytes_to_drive(os.path.basename(DATA_FILE), payload)
+        if backup_id:
+            logger.info(f"✅ Data backup saved to Drive: {backup_id}")
+            save_backup_file_id(backup_id)
     except Exception as e:
-        logger.error(f"Failed to save data: {e}")
+        logger.error(f"Failed to back up data to Drive: {e}")
 
-    if google_enabled and driveservice:
-        try:
-            backup_id, backup_link = upload_file_to_drive(DATA_FILE)
-            if backup_id:
-                logger.info(f"✅ Data backup saved to Drive: {backup_id}")
-                save_backup_file_id(backup_id)
-        except Exception as e:
-            logger.error(f"Failed to back up data to Drive: {e}")
+# ─── Debounced saving ──────────────────────────────────────────────────
+# Routes call request_save(); a single worker coalesces bursts of mutations
+# into one save_data() at most every SAVE_DEBOUNCE_SECONDS.
+# Re-entrant: the worker and flush_save hold it across the flag check and save_data()
+_save_lock = threading.RLock()
+_save_requested = threading.Event()
+
+def request_save():
+    _save_requested.set()
+
+def _save_worker():
+    while True:
+        _save_requested.wait()
+        time.sleep(SAVE_DEBOUNCE_SECONDS)
+        with _save_lock:
+            _save_requested.clear()
+            save_data()
+
+def flush_save():
+    # Waits for an in-flight save from the worker, which teardown would
+    # otherwise kill before its rename lands
+    with _save_lock:
+        if _save_requested.is_set():
+            _save_requested.clear()
+            save_data()
+    # By now concurrent.futures has shut _drive_pool down, so a backup still
+    # pending can't be submitted; upload it on this thread instead
+    if _backup_pending.is_set():
+        _backup_to_drive()
+
+threading.Thread(target=_save_worker, name='save-worker', daemon=True).start()
+atexit.register(flush_save)
 
 class User(UserMixin):
     def __init__(self, username, role):
         self.id = username
         self.role = role
 
+# Flask-Login already memoises current_user per request; this reuses the
+# User object across requests too. The role is part of the key, so a role
+# change yields a fresh object without explicit invalidation.
+@lru_cache(maxsize=1024)
+def _cached_user(username, role):
+    return User(username, role)
+
 @login_manager.user_loader
 def load_user(username):
     u = users.get(username)
-    return User(username, u['role']) if u else None
+    return _cached_user(username, u['role']) if u else None
+
+@app.before_request
+def cache_user_role():
+    # Resolve the current_user proxy once; admin checks then read g.role
+    user = current_user._get_current_object()
+    g.role = user.role if user.is_authenticated else None
 
 def admin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.role != 'admin':
+        if g.get('role') != 'admin':
             flash("Admin access required.", "error")
             return redirect(url_for('index'))
         return f(*args, **kwargs)
@@ -231,8 +355,8 @@ def view_vehicle(vehicle_id):
     return render_template('view_vehicle.html', vehicle=vehicle)
 
 @app.route('/vehicles/add', methods=['GET', 'POST'])
-@admin_required
 @login_required
+@admin_required
 def add_vehicle():
     if request.method == 'POST':
         vehicle_id = request.form.get('vehicle_id')
@@ -247,40 +371,48 @@ def add_vehicle():
             'model': request.form.get('model'),
             'year': request.form.get('year'),
         }
-        save_data()
+        request_save()
         flash("Vehicle added successfully.", "success")
         return redirect(url_for('view_vehicle', vehicle_id=vehicle_id))
     return render_template('add_vehicle.html')
 
 @app.route('/vehicles/<vehicle_id>/edit', methods=['GET', 'POST'])
-@admin_required
 @login_required
+@admin_required
 def edit_vehicle(vehicle_id):
     vehicle = vehicles.get(vehicle_id)
     if not vehicle:
         flash("Vehicle not found.", "error")
         return redirect(url_for('list_vehicles'))
     if request.method == 'POST':
-        vehicle['make'] = request.form.get('make')
-        vehicle['model'] = request.form.get('model')
-        vehicle['year'] = request.form.get('year')
-        save_data()
+        changes = {
+            'make': request.form.get('make'),
+            'model': request.form.get('model'),
+            'year': request.form.get('year'),
+        }
+        if all(vehicle.get(k) == v for k, v in changes.items()):
+            flash("No changes to save.", "info")
+            return redirect(url_for('view_vehicle', vehicle_id=vehicle_id))
+        vehicle.update(changes)
+        request_save()
         flash("Vehicle updated successfully.", "success")
         return redirect(url_for('view_vehicle', vehicle_id=vehicle_id))
     return render_template('edit_vehicle.html', vehicle=vehicle)
 
 @app.route('/vehicles/<vehicle_id>/delete', methods=['POST'])
-@admin_required
 @login_required
+@admin_required
 def delete_vehicle(vehicle_id):
     if vehicle_id in vehicles:
         del vehicles[vehicle_id]
-        save_data()
+        request_save()
         flash("Vehicle deleted successfully.", "success")
     else:
         flash("Vehicle not found.", "error")
     return redirect(url_for('list_vehicles'))
 
-# Initialize services and load data before the first request
-init_google_services()
-load_data()
+# Initialize services and load data before the first request. Under the debug
+# reloader only the serving child does this, so restarts don't restore twice.
+if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    init_google_services()
+    load_data()